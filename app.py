@@ -1,17 +1,33 @@
+import time
+_startup_t0 = time.perf_counter()
+
 from flask import Flask, render_template, jsonify, request
+import signal
 import sqlite3
+import sys
 import threading
-import time
 from datetime import datetime, timedelta
 import subprocess
-import pandas as pd
 import json
 import os
+import socket
+
+import events
+import fleet
+import ringstore
+
+# pandas é importado sob demanda (/data): sozinho leva segundos num Pi Zero
 
 app = Flask(__name__)
+# Corpo máximo de qualquer requisição (lotes do /ingest são os maiores)
+app.config["MAX_CONTENT_LENGTH"] = fleet.MAX_BATCH_BYTES
 
-DB_FILE = "internet.db"
-CONFIG_FILE = "config.json"
+DB_FILE = os.getenv("INTERNET_MONITOR_DB") or "internet.db"
+CONFIG_FILE = os.getenv("INTERNET_MONITOR_CONFIG") or "config.json"
+PAUSE_FILE = "oled_pause_state.txt"
+PORT = int(os.getenv("INTERNET_MONITOR_PORT") or os.getenv("FLASK_RUN_PORT") or 8080)
+# Perfil de inicialização: tempos de import e de cada fase (--profile-startup)
+PROFILE_STARTUP = "--profile-startup" in sys.argv or os.getenv("INTERNET_MONITOR_PROFILE_STARTUP") == "1"
 
 # Configurações padrão
 DEFAULT_CONFIG = {
@@ -20,14 +36,51 @@ DEFAULT_CONFIG = {
     "monitor_end_hour": 18,
     "speedtest_flags": ["--accept-license", "--accept-gdpr", "-f", "json"],
     "skip_download": False,  # Pular teste de download
-    "skip_upload": False     # Pular teste de upload
+    "skip_upload": False,    # Pular teste de upload
+    # Frota: "standalone", "agent" (envia ao agregador) ou "aggregator"
+    "mode": "standalone",
+    "site_id": None,         # Padrão: hostname
+    "aggregator_url": None,  # Ex.: http://central:8080/ingest
+    "ingest_token": None,    # Token compartilhado entre agentes e agregador
+    "push_interval": 60,     # Segundos entre envios
+    "push_batch_size": 500,  # Registros por lote
+    # Armazenamento: "sqlite" (padrão) ou "ring" (anel em memória + SQLite em lote)
+    "storage_backend": "sqlite",
+    "ring_path": None,           # Padrão: /dev/shm/<banco>-<hash>.ring
+    "ring_capacity": 4096,       # Registros no anel
+    "ring_flush_interval": 21600 # Segundos entre descargas no SQLite (6h)
 }
 
 
+# Chaves que nunca saem pela API (/config) nem pelos logs
+SECRET_CONFIG_KEYS = ("ingest_token",)
+
 # Variáveis globais de configuração
 config = DEFAULT_CONFIG.copy()
 config_changed = threading.Event()
 last_test_time = None
+# Resultado da última execução do speedtest (status, detalhe e interface)
+speedtest_outcome = {"status": None, "detail": None, "interface": None}
+# Liberado quando o banco está migrado; rotas que usam o banco aguardam
+db_ready = threading.Event()
+# Anel de medições recentes (storage_backend = "ring"); None usa só o SQLite
+ring = None
+ring_stop = threading.Event()
+# Tentativas de teste guardadas junto com o anel (gravadas na mesma descarga)
+event_log = None
+ring_flush_lock = threading.Lock()
+startup_timings = []
+
+
+def startup_phase(name, since):
+    """Registra a duração de uma fase da inicialização e retorna o instante atual."""
+    now = time.perf_counter()
+    startup_timings.append((name, now - since))
+    if PROFILE_STARTUP:
+        print(f"[PERF] {name}: {(now - since) * 1000:.1f} ms (total {(now - _startup_t0) * 1000:.1f} ms)", flush=True)
+    return now
+
+_imports_done = startup_phase("imports", _startup_t0)
 
 
 
@@ -40,29 +93,33 @@ def load_config():
             with open(CONFIG_FILE, 'r') as f:
                 loaded = json.load(f)
                 config.update(loaded)
-                print(f"[INFO] Configuração carregada: {config}")
+                print(f"[INFO] Configuração carregada: {CONFIG_FILE} (modo: {config.get('mode')})")
         except Exception as e:
             print(f"[ERRO] Falha ao carregar config: {e}")
             config = DEFAULT_CONFIG.copy()
     else:
         save_config()
 
+def public_config():
+    """Configuração sem segredos, para respostas da API e logs."""
+    return {key: value for key, value in config.items() if key not in SECRET_CONFIG_KEYS}
+
 def save_config():
     """Salva configurações no arquivo JSON."""
     try:
         with open(CONFIG_FILE, 'w') as f:
             json.dump(config, f, indent=2)
-        print(f"[INFO] Configuração salva: {config}")
+        print(f"[INFO] Configuração salva: {public_config()}")
         # Sinalizar que a configuração mudou
         config_changed.set()
     except Exception as e:
         print(f"[ERRO] Falha ao salvar config: {e}")
 
 # === Banco de dados ===
-def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("""
+# Migrações em ordem; a versão aplicada fica em PRAGMA user_version,
+# assim cada uma roda uma única vez e a inicialização normal não toca no esquema.
+def _migrate_metrics(conn):
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS metrics (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             timestamp TEXT NOT NULL,
@@ -76,24 +133,40 @@ def init_db():
         )
     """)
     
-    # Migração: adicionar coluna provider se não existir
-    try:
-        cursor.execute("SELECT provider FROM metrics LIMIT 1")
-    except sqlite3.OperationalError:
-        print("[INFO] Adicionando coluna 'provider' à tabela existente...")
-        cursor.execute("ALTER TABLE metrics ADD COLUMN provider TEXT")
-        print("[INFO] Coluna 'provider' adicionada com sucesso!")
+    # Bancos antigos: adicionar colunas que não existiam
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(metrics)")}
+    for column, column_type in (("provider", "TEXT"), ("data_consumed_mb", "REAL")):
+        if column not in columns:
+            print(f"[INFO] Adicionando coluna '{column}' à tabela existente...")
+            conn.execute(f"ALTER TABLE metrics ADD COLUMN {column} {column_type}")
+
+def _index_metrics_timestamp(conn):
+    # Consultas por período e descarga idempotente do anel de medições
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_metrics_timestamp ON metrics (timestamp)")
+
+MIGRATIONS = [
+    _migrate_metrics,
+    events.init_events_db,
+    fleet.init_fleet_db,
+    _index_metrics_timestamp,
+    events.init_unmonitored_db,
+    fleet.add_instance_id,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def init_db():
+    conn = sqlite3.connect(DB_FILE)
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
     
-    # Migração: adicionar coluna data_consumed_mb se não existir
-    try:
-        cursor.execute("SELECT data_consumed_mb FROM metrics LIMIT 1")
-    except sqlite3.OperationalError:
-        print("[INFO] Adicionando coluna 'data_consumed_mb' à tabela existente...")
-        cursor.execute("ALTER TABLE metrics ADD COLUMN data_consumed_mb REAL")
-        print("[INFO] Coluna 'data_consumed_mb' adicionada com sucesso!")
+    if version < SCHEMA_VERSION:
+        for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {number}")
+            conn.commit()
+        print(f"[INFO] Esquema do banco atualizado: v{version} → v{SCHEMA_VERSION}")
     
-    conn.commit()
     conn.close()
+    db_ready.set()
     print("[INFO] Banco de dados inicializado:", DB_FILE)
 
 # === Função para obter estatísticas de rede ===
@@ -133,10 +206,15 @@ def get_network_stats(interface=None):
 
 # === Executa o speedtest oficial ===
 def executar_speedtest():
-    """Executa o speedtest e retorna ping, download, upload, jitter, packet loss, provider e consumo."""
+    """Executa o speedtest e retorna ping, download, upload, jitter, packet loss, provider e consumo.
+
+    O status da execução (success, failure, timeout) fica em speedtest_outcome.
+    """
+    speedtest_outcome.update(status=events.FAILURE, detail=None, interface=None)
     try:
         # Capturar estatísticas de rede antes do teste
         rx_before, tx_before, interface = get_network_stats()
+        speedtest_outcome["interface"] = interface
         
         # Construir comando - usar speedtest-cli ao invés de speedtest
         command = ["speedtest-cli", "--json"]
@@ -157,6 +235,7 @@ def executar_speedtest():
 
         if result.returncode != 0:
             print(f"[ERRO] Speedtest falhou: {result.stderr.strip()}", flush=True)
+            speedtest_outcome["detail"] = result.stderr.strip()[:500]
             return None, None, None, None, None, None, None
 
         data = json.loads(result.stdout)
@@ -186,6 +265,7 @@ def executar_speedtest():
         
         print(f"[INFO] Consumo do teste: {data_consumed_mb:.2f} MB (interface: {interface})", flush=True)
 
+        speedtest_outcome["status"] = events.SUCCESS
         return ping, download, upload, jitter, packet_loss, provider, data_consumed_mb
 
     except FileNotFoundError:
@@ -194,24 +274,72 @@ def executar_speedtest():
         print("  pip install speedtest-cli", flush=True)
         print("ou", flush=True)
         print("  sudo apt install speedtest-cli", flush=True)
+        speedtest_outcome["detail"] = "speedtest-cli não encontrado"
+    except subprocess.TimeoutExpired as e:
+        print(f"[ERRO EXECUTAR_SPEEDTEST] Tempo esgotado após {e.timeout}s", flush=True)
+        speedtest_outcome.update(status=events.TIMEOUT, detail=f"timeout após {e.timeout}s")
     except json.JSONDecodeError as e:
         print(f"[ERRO EXECUTAR_SPEEDTEST] Erro ao interpretar JSON: {e}", flush=True)
         print("Saída recebida:", result.stdout[:200], "...", flush=True)
+        speedtest_outcome["detail"] = f"JSON inválido: {e}"
     except Exception as e:
         print(f"[ERRO EXECUTAR_SPEEDTEST] {e}", flush=True)
+        speedtest_outcome["detail"] = str(e)[:500]
 
     return None, None, None, None, None, None, None
 
+def is_paused():
+    """Verifica se o OLED pausou o monitoramento (arquivo de estado)."""
+    try:
+        with open(PAUSE_FILE, 'r') as f:
+            return f.read().strip() == '1'
+    except OSError:
+        return False
+
+def record_test_event(status, detail=None, interface=None):
+    """Registra uma tentativa de teste sem métrica associada."""
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    if event_log is not None:
+        # Modo anel: vai para o SQLite na próxima descarga
+        event_log.append({"timestamp": timestamp, "status": status, "detail": detail, "interface": interface})
+        return
+    conn = sqlite3.connect(DB_FILE)
+    events.record_test(conn, timestamp, status, detail=detail, interface=interface)
+    conn.commit()
+    conn.close()
+
+def events_connection():
+    """Conexão para consultas de eventos que enxerga as tentativas ainda no anel.
+
+    As pendências são aplicadas em uma transação nunca confirmada, com journal
+    em memória: quem fecha a conexão a desfaz sem gravar no cartão SD.
+    """
+    conn = sqlite3.connect(DB_FILE)
+    pending = event_log.pending() if event_log is not None else []
+    if pending:
+        conn.execute("PRAGMA journal_mode = MEMORY")
+        events.apply_pending(conn, pending, quiet=True)
+    return conn
+
 # === Coletor de dados (usando Ookla) ===
 def collect_metrics():
     global last_test_time
     
     print("[INFO] Thread de coleta iniciada!", flush=True)
+    # Último motivo de pulo registrado (evita um evento a cada despertar)
+    last_skip = None
     
     while True:
         try:
             # Verificar se o OLED pausou o monitoramento
-            
+            if is_paused():
+                if last_skip != events.SKIPPED_PAUSED:
+                    record_test_event(events.SKIPPED_PAUSED, detail="pausado pelo OLED")
+                    last_skip = events.SKIPPED_PAUSED
+                print("[INFO] Monitoramento pausado pelo OLED. Aguardando...", flush=True)
+                config_changed.wait(timeout=30)
+                config_changed.clear()
+                continue
             
             # Verificar se está dentro do horário de monitoramento
             current_hour = datetime.now().hour
@@ -219,6 +347,9 @@ def collect_metrics():
             end_hour = config["monitor_end_hour"]
             
             if current_hour < start_hour or current_hour >= end_hour:
+                if last_skip != events.SKIPPED_SCHEDULE:
+                    record_test_event(events.SKIPPED_SCHEDULE, detail=f"fora do horário {start_hour}h-{end_hour}h")
+                    last_skip = events.SKIPPED_SCHEDULE
                 print(f"[INFO] Fora do horário de monitoramento ({start_hour}h-{end_hour}h). Aguardando...", flush=True)
                 # Aguardar até entrar no horário ou config mudar
                 config_changed.wait(timeout=300)  # 5 minutos
@@ -249,22 +380,41 @@ def collect_metrics():
                     print(f"[INFO] Intervalo completo ({time_since_last:.0f}s >= {interval}s) - executando teste...", flush=True)
             
             # Executar o teste
+            last_skip = None
             print("[INFO] Executando speedtest oficial...", flush=True)
             ping, download, upload, jitter, packet_loss, provider, data_consumed = executar_speedtest()
 
             if ping is not None and download is not None and upload is not None:
                 last_test_time = datetime.now()
-                conn = sqlite3.connect(DB_FILE)
-                cursor = conn.cursor()
-                cursor.execute(
-                    "INSERT INTO metrics (timestamp, ping_avg, download_mbps, upload_mbps, jitter, packet_loss, provider, data_consumed_mb) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                    (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), ping, download, upload, jitter, packet_loss, provider, data_consumed)
-                )
-                conn.commit()
-                conn.close()
+                timestamp = last_test_time.strftime("%Y-%m-%d %H:%M:%S")
+                row = (timestamp, ping, download, upload, jitter, packet_loss, provider, data_consumed)
+                if ring is not None:
+                    # Mesmo nome (cortado) no anel, em providers e em test_events
+                    provider = ringstore.fit_provider(provider)
+                    row = row[:6] + (provider,) + row[7:]
+                    # Medição e tentativa vão para o SQLite na próxima descarga do anel
+                    ring.append(dict(zip(ringstore.FIELDS, row)), db_file=DB_FILE)
+                    event_log.append({"timestamp": timestamp, "status": events.SUCCESS,
+                                      "provider": provider, "interface": speedtest_outcome["interface"]})
+                else:
+                    conn = sqlite3.connect(DB_FILE)
+                    cursor = conn.cursor()
+                    cursor.execute(
+                        "INSERT INTO metrics (timestamp, ping_avg, download_mbps, upload_mbps, jitter, packet_loss, provider, data_consumed_mb) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        row
+                    )
+                    events.record_test(conn, timestamp, events.SUCCESS, provider=provider,
+                                       interface=speedtest_outcome["interface"], metric_id=cursor.lastrowid)
+                    conn.commit()
+                    conn.close()
                 print(f"[OK] Registro salvo: provider={provider} | ping={ping:.2f} ms | jitter={jitter:.2f} ms | ↓ {download:.2f} Mbps | ↑ {upload:.2f} Mbps | perda={packet_loss:.2f}% | consumo={data_consumed:.2f} MB", flush=True)
             else:
                 # Se falhou, NÃO atualizar last_test_time para tentar novamente mais rápido
+                status = speedtest_outcome["status"]
+                if status == events.SUCCESS:
+                    status = events.FAILURE  # JSON sem os campos esperados
+                record_test_event(status, detail=speedtest_outcome["detail"],
+                                  interface=speedtest_outcome["interface"])
                 print("[WARN] Speedtest retornou dados incompletos. Tentando novamente em 60s...", flush=True)
                 time.sleep(60)  # Aguardar 1 minuto antes de tentar novamente
                 continue
@@ -284,10 +434,8 @@ def index():
 # === API de provedores disponíveis ===
 @app.route("/providers")
 def providers():
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT DISTINCT provider FROM metrics WHERE provider IS NOT NULL ORDER BY provider")
-    providers_list = [row[0] for row in cursor.fetchall()]
+    conn = events_connection()
+    providers_list = events.list_providers(conn)
     conn.close()
     return jsonify(providers_list)
 
@@ -318,6 +466,17 @@ def data_usage():
     
     conn.close()
     
+    # Medições ainda no anel (não descarregadas)
+    if ring is not None:
+        pending = ring.pending()
+        test_count += len(pending)
+        daily_map = {item["date"]: item["mb"] or 0 for item in daily}
+        for row in pending:
+            mb = row["data_consumed_mb"] or 0
+            total += mb
+            daily_map[row["timestamp"][:10]] = daily_map.get(row["timestamp"][:10], 0) + mb
+        daily = [{"date": day, "mb": mb} for day, mb in sorted(daily_map.items(), reverse=True)]
+    
     return jsonify({
         "total_mb": round(total, 2),
         "total_gb": round(total / 1024, 2),
@@ -358,7 +517,7 @@ def get_status():
 # === API de configuração ===
 @app.route("/config")
 def get_config():
-    return jsonify(config)
+    return jsonify(public_config())
 
 @app.route("/config", methods=["POST"])
 def update_config():
@@ -396,18 +555,15 @@ def update_config():
             config["skip_upload"] = bool(new_config["skip_upload"])
         
         save_config()
-        return jsonify({"success": True, "config": config})
+        return jsonify({"success": True, "config": public_config()})
     
     except Exception as e:
         return jsonify({"error": str(e)}), 400
 
 # === API de dados para o dashboard ===
-@app.route("/data")
-def data():
-    time_range = request.args.get("range", "1h")
-    provider_filter = request.args.get("provider", "all")
+def range_start(time_range):
+    """Converte o parâmetro range (1h, 4h, ..., total) no instante inicial."""
     now = datetime.now()
-
     ranges = {
         "1h": now - timedelta(hours=1),
         "4h": now - timedelta(hours=4),
@@ -416,8 +572,15 @@ def data():
         "7d": now - timedelta(days=7),
         "total": datetime(1970, 1, 1)
     }
-    start_time = ranges.get(time_range, ranges["1h"])
+    return ranges.get(time_range, ranges["1h"])
+
+@app.route("/data")
+def data():
+    time_range = request.args.get("range", "1h")
+    provider_filter = request.args.get("provider", "all")
+    start_time = range_start(time_range)
 
+    import pandas as pd
     conn = sqlite3.connect(DB_FILE)
     
     if provider_filter == "all":
@@ -435,9 +598,63 @@ def data():
     
     conn.close()
 
+    # Juntar as medições recentes ainda no anel
+    if ring is not None:
+        pending = ring.pending(since=start_time, provider=None if provider_filter == "all" else provider_filter)
+        if pending:
+            recent = pd.DataFrame(pending)
+            df = recent if df.empty else pd.concat([df, recent], ignore_index=True)
+            df = df.drop_duplicates(subset="timestamp").sort_values("timestamp", ignore_index=True)
+
+    return jsonify(build_data_response(df, points_hint()))
+
+def points_hint():
+    """Resolução pedida pelo cliente (largura do gráfico em pixels); None = série completa."""
+    try:
+        points = int(request.args.get("points", 0))
+    except ValueError:
+        return None
+    return min(max(points, 10), 5000) if points > 0 else None
+
+def downsample(df, points):
+    """Reduz a série a no máximo ``points`` intervalos de tempo iguais.
+
+    Métricas viram a média do intervalo, o consumo é somado e o provedor
+    (ou site) é o último do intervalo.
+    """
+    import pandas as pd
+
+    if not points or len(df) <= points:
+        return df
+    ts = pd.to_datetime(df["timestamp"])
+    span = (ts.iloc[-1] - ts.iloc[0]).total_seconds()
+    if span <= 0:
+        return df
+    bucket = ((ts - ts.iloc[0]).dt.total_seconds() * (points - 1) / span).astype(int)
+
+    agg = {"timestamp": "first"}
+    for column in ("ping_avg", "download_mbps", "upload_mbps", "jitter", "packet_loss"):
+        if column in df.columns:
+            agg[column] = "mean"
+    if "data_consumed_mb" in df.columns:
+        agg["data_consumed_mb"] = "sum"
+    for column in ("provider", "site_id"):
+        if column in df.columns:
+            agg[column] = "last"
+    return df.groupby(bucket, sort=True).agg(agg).reset_index(drop=True)
+
+def build_data_response(df, points=None):
+    """Monta a resposta do /data (séries, estatísticas e consumo) a partir do DataFrame.
+
+    Estatísticas e consumo do período usam todos os registros; as séries
+    são reduzidas a ``points`` quando informado.
+    """
+    import pandas as pd
+
     if df.empty:
-        return jsonify({
+        return {
             "timestamps": [], 
+            "timestamps_ms": [],
             "ping": [], 
             "download": [], 
             "upload": [],
@@ -453,7 +670,7 @@ def data():
                 "jitter": {"min": 0, "max": 0},
                 "packet_loss": {"min": 0, "max": 0}
             }
-        })
+        }
 
     # Calcular estatísticas
     stats = {
@@ -487,13 +704,19 @@ def data():
         if pd.isna(total_data_consumed):
             total_data_consumed = 0
 
+    df = downsample(df, points)
+
     # Preparar listas de dados, substituindo NaN por None ou 0
     data_consumed_list = []
     if "data_consumed_mb" in df.columns:
         data_consumed_list = [0 if pd.isna(x) else float(x) for x in df["data_consumed_mb"].tolist()]
 
-    return jsonify({
+    # Horário local (relógio de parede) em ms; o dashboard formata em UTC para não deslocar
+    timestamps_ms = ((pd.to_datetime(df["timestamp"]) - pd.Timestamp(0)) // pd.Timedelta(milliseconds=1)).tolist()
+
+    response = {
         "timestamps": df["timestamp"].tolist(),
+        "timestamps_ms": timestamps_ms,
         "ping": df["ping_avg"].tolist(),
         "download": df["download_mbps"].tolist(),
         "upload": df["upload_mbps"].tolist(),
@@ -503,16 +726,219 @@ def data():
         "data_consumed": data_consumed_list,
         "total_data_consumed_mb": total_data_consumed,
         "stats": stats
-    })
+    }
+    if "site_id" in df.columns:
+        response["sites"] = df["site_id"].tolist()
+    return response
+
+# === Linha do tempo de testes e disponibilidade ===
+@app.route("/events")
+def test_events():
+    time_range = request.args.get("range", "1d")
+    try:
+        limit = min(max(int(request.args.get("limit", 500)), 1), 5000)
+    except ValueError:
+        limit = 500
+    start_time = range_start(time_range)
+
+    conn = events_connection()
+    events_list = events.list_events(conn, start_time.strftime("%Y-%m-%d %H:%M:%S"), limit)
+    conn.close()
+    return jsonify(events_list)
+
+@app.route("/availability")
+def availability():
+    time_range = request.args.get("range", "1d")
+    start_time = range_start(time_range)
+
+    conn = events_connection()
+    result = events.availability(conn, start_time, datetime.now())
+    conn.close()
+    return jsonify(result)
+
+# === Frota: ingestão e consultas do agregador ===
+@app.route("/ingest", methods=["POST"])
+def ingest():
+    """Recebe lotes NDJSON (gzip) enviados pelos agentes."""
+    if config.get("mode") != "aggregator":
+        return jsonify({"error": "Este monitor não está em modo agregador"}), 404
+
+    auth = request.headers.get("Authorization", "")
+    token = auth[len("Bearer "):] if auth.startswith("Bearer ") else ""
+    if not fleet.check_token(token, config.get("ingest_token")):
+        return jsonify({"error": "Token inválido"}), 401
+
+    site_id = (request.headers.get("X-Site-Id") or request.args.get("site") or "").strip()
+    if not site_id:
+        return jsonify({"error": "Identificador do site (X-Site-Id) é obrigatório"}), 400
+
+    if request.content_length is not None and request.content_length > fleet.MAX_BATCH_BYTES:
+        return jsonify({"error": "Lote excede o tamanho máximo"}), 413
+
+    # Agentes antigos não enviam a instância: chave vazia
+    instance_id = request.headers.get("X-Instance-Id", "").strip()
+    if len(instance_id) > 64:
+        return jsonify({"error": "X-Instance-Id inválido"}), 400
+
+    compressed = request.headers.get("Content-Encoding", "").lower() == "gzip"
+    try:
+        rows = fleet.decode_batch(request.get_data(), compressed=compressed)
+    except fleet.BatchError as e:
+        return jsonify({"error": str(e)}), 400
+
+    inserted = fleet.store_batch(DB_FILE, site_id, instance_id, rows, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    return jsonify({"accepted": len(rows), "inserted": inserted})
+
+@app.route("/sites")
+def sites():
+    return jsonify(fleet.list_sites(DB_FILE))
+
+@app.route("/fleet/data")
+def fleet_data():
+    """Mesmo formato do /data, sobre os registros de um site ou de todos."""
+    time_range = request.args.get("range", "1h")
+    site_filter = request.args.get("site", "all")
+    provider_filter = request.args.get("provider", "all")
+    start_time = range_start(time_range)
+
+    query = "SELECT * FROM site_metrics WHERE timestamp >= ?"
+    params = [start_time.strftime("%Y-%m-%d %H:%M:%S")]
+    if site_filter != "all":
+        query += " AND site_id = ?"
+        params.append(site_filter)
+    if provider_filter != "all":
+        query += " AND provider = ?"
+        params.append(provider_filter)
+    query += " ORDER BY timestamp ASC"
+
+    import pandas as pd
+    conn = sqlite3.connect(DB_FILE)
+    df = pd.read_sql_query(query, conn, params=params)
+    conn.close()
+
+    response = build_data_response(df, points_hint())
+    response.setdefault("sites", [])
+    return jsonify(response)
 
 # === Inicialização ===
+@app.before_request
+def wait_for_db():
+    """Rotas que usam o banco aguardam as migrações; a página inicial não."""
+    if request.endpoint not in ("index", "static"):
+        db_ready.wait(timeout=30)
+
+@app.after_request
+def log_first_response(response):
+    if PROFILE_STARTUP and not any(name == "first_response" for name, _ in startup_timings):
+        startup_phase("first_response", _startup_t0)
+    return response
+
+def start_ring(mode):
+    """Abre o anel de medições e inicia a descarga periódica no SQLite."""
+    global ring, event_log
+    path = config.get("ring_path") or ringstore.default_path(DB_FILE)
+    try:
+        ring = ringstore.RingStore(path, capacity=int(config.get("ring_capacity", 4096)))
+    except (OSError, ValueError) as e:
+        print(f"[ERRO] Falha ao abrir anel {path}: {e}. Usando apenas SQLite", flush=True)
+        return
+    event_log = ringstore.EventLog(path + ".events")
+    print(f"[INFO] Anel de medições: {path} ({ring.capacity} registros, {ring.pending_count()} pendentes)", flush=True)
+    interval = int(config.get("ring_flush_interval", 21600))
+    if mode == "agent":
+        # O agente envia a partir de metrics (ids locais estáveis); o anel não
+        # pode segurar medições por mais tempo que o intervalo de envio
+        push_interval = int(config.get("push_interval", 60))
+        if interval > push_interval:
+            print(f"[INFO] Modo agente: descarga do anel a cada {push_interval}s (push_interval) em vez de {interval}s", flush=True)
+            interval = push_interval
+    threading.Thread(
+        target=ringstore.flush_loop,
+        args=(flush_ring_to_sqlite, interval, ring_stop),
+        daemon=True
+    ).start()
+
+def flush_ring_to_sqlite():
+    """Descarrega medições e tentativas pendentes no SQLite, em uma transação."""
+    with ring_flush_lock:
+        pending = event_log.pending()
+        count = ring.flush_to_sqlite(
+            DB_FILE,
+            before_commit=(lambda conn: events.apply_pending(conn, pending)) if pending else None
+        )
+        event_log.drop(len(pending))
+    if pending:
+        print(f"[INFO] Tentativas de teste gravadas no SQLite: {len(pending)}", flush=True)
+    return count
+
+def flush_ring():
+    """Descarrega o anel no SQLite (encerramento do serviço)."""
+    ring_stop.set()
+    if ring is not None:
+        count = flush_ring_to_sqlite()
+        print(f"[INFO] Anel descarregado no encerramento: {count} registros", flush=True)
+
+def start_background(mode):
+    """Migra o banco e inicia coleta/envio, em paralelo ao servidor web.
+
+    Se a inicialização falhar, encerra o processo (como antes, quando rodava
+    na thread principal) para o systemd reiniciar o serviço.
+    """
+    try:
+        _start_background(mode)
+    except Exception as e:
+        print(f"[ERRO] Falha na inicialização do banco/coleta: {e}", flush=True)
+        import traceback
+        traceback.print_exc()
+        sys.stdout.flush()
+        os._exit(1)
+
+def _start_background(mode):
+    t = time.perf_counter()
+    init_db()
+    t = startup_phase("init_db", t)
+
+    if config.get("storage_backend") == "ring" and mode != "aggregator":
+        start_ring(mode)
+
+    if mode == "aggregator":
+        # O agregador só recebe dados; não executa speedtests
+        print("[INFO] Modo agregador: aguardando lotes em /ingest", flush=True)
+    else:
+        # Inicia coleta em background
+        collector_thread = threading.Thread(target=collect_metrics, daemon=True)
+        collector_thread.start()
+
+    if mode == "agent":
+        if not config.get("aggregator_url") or not config.get("ingest_token"):
+            print("[ERRO] Modo agente requer 'aggregator_url' e 'ingest_token' no config", flush=True)
+        else:
+            push_thread = threading.Thread(
+                target=fleet.push_loop,
+                args=(DB_FILE, config["aggregator_url"], config.get("site_id") or socket.gethostname(),
+                      config["ingest_token"]),
+                kwargs={
+                    "interval": config.get("push_interval", 60),
+                    "batch_size": config.get("push_batch_size", 500),
+                },
+                daemon=True
+            )
+            push_thread.start()
+    startup_phase("background_threads", t)
+
 if __name__ == "__main__":
+    t = time.perf_counter()
     load_config()
-    init_db()
+    t = startup_phase("load_config", t)
 
-    # Inicia coleta em background
-    collector_thread = threading.Thread(target=collect_metrics, daemon=True)
-    collector_thread.start()
+    # systemd encerra com SIGTERM: converter em saída normal para descarregar o anel
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
-    print("[INFO] Servidor Flask iniciado em http://0.0.0.0:8080")
-    app.run(host="0.0.0.0", port=8080, debug=False)
+    threading.Thread(target=start_background, args=(config.get("mode", "standalone"),), daemon=True).start()
+
+    print(f"[INFO] Servidor Flask iniciado em http://0.0.0.0:{PORT}")
+    startup_phase("ready_to_serve", _startup_t0)
+    try:
+        app.run(host="0.0.0.0", port=PORT, debug=False)
+    finally:
+        flush_ring()
@@ -0,0 +1,259 @@
+"""
+Linha do tempo de testes, provedores e quedas
+Registro de eventos (tentativas de teste, trocas de provedor/interface)
+com tabelas materializadas mantidas incrementalmente:
+- providers: provedores vistos, primeiro/último teste e contagem
+- outages: intervalos de indisponibilidade (abertos na primeira falha,
+  fechados no próximo teste bem-sucedido ou quando o monitoramento para)
+- unmonitored: intervalos sem monitoramento (fora do horário ou pausado),
+  descontados do tempo observado na disponibilidade
+"""
+
+from datetime import datetime
+
+TS_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Status possíveis de uma tentativa de teste
+SUCCESS = "success"
+FAILURE = "failure"
+TIMEOUT = "timeout"
+SKIPPED_SCHEDULE = "skipped_schedule"
+SKIPPED_PAUSED = "skipped_paused"
+
+# Status que indicam indisponibilidade da conexão
+OUTAGE_STATUSES = (FAILURE, TIMEOUT)
+# Status de testes não executados (monitoramento parado)
+SKIP_STATUSES = (SKIPPED_SCHEDULE, SKIPPED_PAUSED)
+
+
+# === Banco de dados ===
+def init_events_db(conn):
+    """Cria as tabelas de eventos e preenche provedores a partir de metrics."""
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS test_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            status TEXT,
+            detail TEXT,
+            provider TEXT,
+            interface TEXT,
+            metric_id INTEGER
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_test_events_ts ON test_events (timestamp)")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS providers (
+            name TEXT PRIMARY KEY,
+            first_seen TEXT NOT NULL,
+            last_seen TEXT NOT NULL,
+            test_count INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS outages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            started_at TEXT NOT NULL,
+            ended_at TEXT,
+            reason TEXT
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_outages_started ON outages (started_at)")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS event_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    """)
+
+    # Backfill único: bancos antigos já têm provedores em metrics
+    cursor.execute("SELECT COUNT(*) FROM providers")
+    if cursor.fetchone()[0] == 0:
+        cursor.execute("""
+            INSERT INTO providers (name, first_seen, last_seen, test_count)
+            SELECT provider, MIN(timestamp), MAX(timestamp), COUNT(*)
+            FROM metrics
+            WHERE provider IS NOT NULL
+            GROUP BY provider
+        """)
+        if cursor.rowcount > 0:
+            print(f"[INFO] Tabela 'providers' preenchida com {cursor.rowcount} provedores", flush=True)
+
+
+def init_unmonitored_db(conn):
+    """Cria a tabela de intervalos sem monitoramento."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS unmonitored (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            started_at TEXT NOT NULL,
+            ended_at TEXT,
+            reason TEXT
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_unmonitored_started ON unmonitored (started_at)")
+
+
+def _get_state(conn, key):
+    row = conn.execute("SELECT value FROM event_state WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+
+def _set_state(conn, key, value):
+    conn.execute(
+        "INSERT INTO event_state (key, value) VALUES (?, ?) "
+        "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+        (key, value)
+    )
+
+
+def _insert_event(conn, timestamp, kind, status=None, detail=None, provider=None,
+                  interface=None, metric_id=None):
+    conn.execute(
+        "INSERT INTO test_events (timestamp, kind, status, detail, provider, interface, metric_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (timestamp, kind, status, detail, provider, interface, metric_id)
+    )
+
+
+def _observe_switch(conn, timestamp, kind, key, value, quiet=False):
+    """Registra troca de provedor/interface quando o valor muda."""
+    if not value:
+        return
+    previous = _get_state(conn, key)
+    if previous is not None and previous != value:
+        _insert_event(conn, timestamp, kind, detail=f"{previous} -> {value}",
+                      provider=value if key == "provider" else None,
+                      interface=value if key == "interface" else None)
+        if not quiet:
+            print(f"[INFO] Troca de {key}: {previous} → {value}", flush=True)
+    if previous != value:
+        _set_state(conn, key, value)
+
+
+# === Registro de tentativas ===
+def record_test(conn, timestamp, status, detail=None, provider=None, interface=None,
+                metric_id=None, quiet=False):
+    """Registra uma tentativa de teste e atualiza provedores e quedas.
+
+    Não faz commit: o chamador grava junto com a métrica (se houver).
+    ``quiet`` omite o log de trocas (consultas que desfazem a transação).
+    """
+    _insert_event(conn, timestamp, "test", status, detail, provider, interface, metric_id)
+
+    if status in SKIP_STATUSES:
+        # Sem testes não há como afirmar que a queda continua: fecha no pulo
+        conn.execute("UPDATE outages SET ended_at = ? WHERE ended_at IS NULL", (timestamp,))
+        open_gap = conn.execute("SELECT id FROM unmonitored WHERE ended_at IS NULL").fetchone()
+        if open_gap is None:
+            conn.execute("INSERT INTO unmonitored (started_at, reason) VALUES (?, ?)", (timestamp, status))
+        return
+
+    # Um teste executado encerra o período sem monitoramento
+    conn.execute("UPDATE unmonitored SET ended_at = ? WHERE ended_at IS NULL", (timestamp,))
+
+    if status == SUCCESS:
+        _observe_switch(conn, timestamp, "provider_change", "provider", provider, quiet)
+        _observe_switch(conn, timestamp, "interface_change", "interface", interface, quiet)
+        if provider:
+            conn.execute("""
+                INSERT INTO providers (name, first_seen, last_seen, test_count)
+                VALUES (?, ?, ?, 1)
+                ON CONFLICT(name) DO UPDATE SET
+                    last_seen = excluded.last_seen,
+                    test_count = test_count + 1
+            """, (provider, timestamp, timestamp))
+        conn.execute("UPDATE outages SET ended_at = ? WHERE ended_at IS NULL", (timestamp,))
+    elif status in OUTAGE_STATUSES:
+        _observe_switch(conn, timestamp, "interface_change", "interface", interface, quiet)
+        open_outage = conn.execute("SELECT id FROM outages WHERE ended_at IS NULL").fetchone()
+        if open_outage is None:
+            conn.execute("INSERT INTO outages (started_at, reason) VALUES (?, ?)", (timestamp, status))
+
+
+def apply_pending(conn, pending, quiet=False):
+    """Aplica tentativas guardadas no modo anel, na ordem em que ocorreram.
+
+    Tentativas já registradas (mesmo horário e status) são ignoradas, para que
+    uma queda entre o commit e a limpeza do arquivo não as duplique.
+    """
+    for event in pending:
+        timestamp, status = event["timestamp"], event["status"]
+        exists = conn.execute(
+            "SELECT 1 FROM test_events WHERE timestamp = ? AND kind = 'test' AND status = ?",
+            (timestamp, status)
+        ).fetchone()
+        if exists:
+            continue
+        metric_id = None
+        if status == SUCCESS:
+            row = conn.execute("SELECT id FROM metrics WHERE timestamp = ?", (timestamp,)).fetchone()
+            metric_id = row[0] if row else None
+        record_test(conn, timestamp, status, detail=event.get("detail"),
+                    provider=event.get("provider"), interface=event.get("interface"),
+                    metric_id=metric_id, quiet=quiet)
+
+
+# === Consultas ===
+def list_providers(conn):
+    return [row[0] for row in conn.execute("SELECT name FROM providers ORDER BY name")]
+
+
+def list_events(conn, start, limit=500):
+    cursor = conn.execute(
+        "SELECT timestamp, kind, status, detail, provider, interface FROM test_events "
+        "WHERE timestamp >= ? ORDER BY timestamp DESC, id DESC LIMIT ?",
+        (start, limit)
+    )
+    columns = ("timestamp", "kind", "status", "detail", "provider", "interface")
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def _overlaps(conn, table, start, end):
+    """Intervalos de ``table`` que cruzam [start, end] e a soma da sobreposição em segundos."""
+    cursor = conn.execute(
+        f"SELECT started_at, ended_at, reason FROM {table} "
+        "WHERE started_at < ? AND (ended_at IS NULL OR ended_at > ?) ORDER BY started_at",
+        (end.strftime(TS_FORMAT), start.strftime(TS_FORMAT))
+    )
+    total = 0.0
+    intervals = []
+    for i_start, i_end, reason in cursor.fetchall():
+        s = max(start, datetime.strptime(i_start, TS_FORMAT))
+        e = min(end, datetime.strptime(i_end, TS_FORMAT)) if i_end else end
+        if e > s:
+            total += (e - s).total_seconds()
+        intervals.append({"start": i_start, "end": i_end, "reason": reason})
+    return total, intervals
+
+
+def availability(conn, start, end):
+    """Calcula a disponibilidade em [start, end] por aritmética de intervalos.
+
+    O período observado começa no primeiro evento registrado e exclui os
+    intervalos sem monitoramento (fora do horário ou pausado); quedas são
+    encerradas quando o monitoramento para, então não se sobrepõem a eles.
+    """
+    first = conn.execute("SELECT MIN(timestamp) FROM test_events").fetchone()[0]
+    if first is not None:
+        start = max(start, datetime.strptime(first, TS_FORMAT))
+
+    unmonitored, _ = _overlaps(conn, "unmonitored", start, end)
+    downtime, intervals = _overlaps(conn, "outages", start, end)
+    observed = (end - start).total_seconds() - unmonitored
+
+    if first is None or observed <= 0:
+        return {
+            "availability": None,
+            "observed_seconds": 0,
+            "unmonitored_seconds": int(unmonitored),
+            "downtime_seconds": 0,
+            "outages": intervals
+        }
+
+    return {
+        "availability": round(100 * (1 - downtime / observed), 3),
+        "observed_seconds": int(observed),
+        "unmonitored_seconds": int(unmonitored),
+        "downtime_seconds": int(downtime),
+        "outages": intervals
+    }
@@ -0,0 +1,307 @@
+"""
+Agregação de várias sondas (frota) em um coletor central
+Lotes em NDJSON comprimido (gzip), armazenamento por site no agregador
+e agente de envio com retentativas e backoff exponencial
+"""
+
+import gzip
+import hmac
+import io
+import json
+import random
+import sqlite3
+import time
+import uuid
+from datetime import datetime
+
+# Colunas de métricas enviadas pelos agentes (mesma ordem da tabela metrics)
+METRIC_FIELDS = (
+    "timestamp",
+    "ping_avg",
+    "download_mbps",
+    "upload_mbps",
+    "jitter",
+    "packet_loss",
+    "provider",
+    "data_consumed_mb",
+)
+
+TS_FORMAT = "%Y-%m-%d %H:%M:%S"
+NUMERIC_FIELDS = ("ping_avg", "download_mbps", "upload_mbps", "jitter", "packet_loss", "data_consumed_mb")
+# source_id é INTEGER do SQLite (64 bits com sinal)
+MAX_SOURCE_ID = 2 ** 63 - 1
+
+# Limite do corpo de um lote, recebido e descomprimido (protege contra "gzip bombs")
+MAX_BATCH_BYTES = 16 * 1024 * 1024
+
+
+class BatchError(ValueError):
+    """Lote recebido em formato inválido."""
+
+
+# === Banco de dados ===
+def init_fleet_db(conn):
+    """Cria as tabelas do agregador e o cursor de envio do agente."""
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS site_metrics (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            site_id TEXT NOT NULL,
+            source_id INTEGER NOT NULL,
+            timestamp TEXT NOT NULL,
+            ping_avg REAL,
+            download_mbps REAL,
+            upload_mbps REAL,
+            jitter REAL,
+            packet_loss REAL,
+            provider TEXT,
+            data_consumed_mb REAL,
+            received_at TEXT NOT NULL,
+            UNIQUE (site_id, source_id)
+        )
+    """)
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_site_metrics_site_ts ON site_metrics (site_id, timestamp)"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_site_metrics_ts ON site_metrics (timestamp)"
+    )
+    # Último id local já aceito pelo agregador e id da instância (modo agente)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS push_state (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    """)
+
+
+def add_instance_id(conn):
+    """Inclui a instância do banco do agente na chave de deduplicação.
+
+    Um banco recriado (cartão SD trocado) recomeça os ids em 1; com a
+    instância na chave, esses registros não são descartados como reenvio.
+    """
+    conn.execute("""
+        CREATE TABLE site_metrics_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            site_id TEXT NOT NULL,
+            instance_id TEXT NOT NULL DEFAULT '',
+            source_id INTEGER NOT NULL,
+            timestamp TEXT NOT NULL,
+            ping_avg REAL,
+            download_mbps REAL,
+            upload_mbps REAL,
+            jitter REAL,
+            packet_loss REAL,
+            provider TEXT,
+            data_consumed_mb REAL,
+            received_at TEXT NOT NULL,
+            UNIQUE (site_id, instance_id, source_id)
+        )
+    """)
+    conn.execute(f"""
+        INSERT INTO site_metrics_new (id, site_id, source_id, {', '.join(METRIC_FIELDS)}, received_at)
+        SELECT id, site_id, source_id, {', '.join(METRIC_FIELDS)}, received_at FROM site_metrics
+    """)
+    conn.execute("DROP TABLE site_metrics")
+    conn.execute("ALTER TABLE site_metrics_new RENAME TO site_metrics")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_site_metrics_site_ts ON site_metrics (site_id, timestamp)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_site_metrics_ts ON site_metrics (timestamp)")
+
+
+# === Codificação dos lotes ===
+def encode_batch(rows):
+    """Serializa uma lista de dicts em NDJSON comprimido com gzip."""
+    body = "\n".join(json.dumps(row, separators=(",", ":")) for row in rows)
+    return gzip.compress(body.encode("utf-8"))
+
+
+def decode_batch(payload, compressed=True):
+    """Converte o corpo recebido (NDJSON, opcionalmente gzip) em lista de dicts."""
+    if compressed:
+        try:
+            with gzip.GzipFile(fileobj=io.BytesIO(payload)) as f:
+                payload = f.read(MAX_BATCH_BYTES + 1)
+        except (OSError, EOFError) as e:
+            raise BatchError(f"gzip inválido: {e}")
+    if len(payload) > MAX_BATCH_BYTES:
+        raise BatchError("Lote excede o tamanho máximo")
+
+    rows = []
+    for line_no, line in enumerate(payload.decode("utf-8", errors="replace").splitlines(), 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise BatchError(f"Linha {line_no}: JSON inválido ({e})")
+        if not isinstance(row, dict) or "id" not in row or not row.get("timestamp"):
+            raise BatchError(f"Linha {line_no}: campos 'id' e 'timestamp' são obrigatórios")
+        _validate_row(row, line_no)
+        rows.append(row)
+    return rows
+
+
+def _validate_row(row, line_no):
+    """Rejeita linhas que quebrariam a gravação ou as consultas do agregador."""
+    row_id = row["id"]
+    if not isinstance(row_id, int) or isinstance(row_id, bool) or not 0 < row_id <= MAX_SOURCE_ID:
+        raise BatchError(f"Linha {line_no}: 'id' deve ser um inteiro positivo de 64 bits")
+    try:
+        datetime.strptime(row["timestamp"], TS_FORMAT)
+    except (TypeError, ValueError):
+        raise BatchError(f"Linha {line_no}: 'timestamp' deve estar no formato {TS_FORMAT}")
+    for field in NUMERIC_FIELDS:
+        value = row.get(field)
+        if value is not None and (not isinstance(value, (int, float)) or isinstance(value, bool)):
+            raise BatchError(f"Linha {line_no}: '{field}' deve ser numérico ou nulo")
+    provider = row.get("provider")
+    if provider is not None and not isinstance(provider, str):
+        raise BatchError(f"Linha {line_no}: 'provider' deve ser texto ou nulo")
+
+
+def check_token(provided, expected):
+    """Compara o token recebido com o configurado em tempo constante."""
+    if not expected or not provided:
+        return False
+    return hmac.compare_digest(provided.encode("utf-8"), expected.encode("utf-8"))
+
+
+# === Agregador ===
+def store_batch(db_file, site_id, instance_id, rows, received_at):
+    """Grava um lote de um site. Reenvios do mesmo id local (na mesma instância) são ignorados."""
+    values = [
+        (site_id, instance_id, row["id"]) + tuple(row.get(field) for field in METRIC_FIELDS) + (received_at,)
+        for row in rows
+    ]
+    conn = sqlite3.connect(db_file)
+    cursor = conn.cursor()
+    before = conn.total_changes
+    cursor.executemany(
+        "INSERT OR IGNORE INTO site_metrics (site_id, instance_id, source_id, timestamp, ping_avg, download_mbps, upload_mbps, jitter, packet_loss, provider, data_consumed_mb, received_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        values
+    )
+    conn.commit()
+    inserted = conn.total_changes - before
+    conn.close()
+    return inserted
+
+
+def list_sites(db_file):
+    """Lista os sites conhecidos com contagem e último registro recebido."""
+    conn = sqlite3.connect(db_file)
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT site_id, COUNT(*), MAX(timestamp), MAX(received_at)
+        FROM site_metrics
+        GROUP BY site_id
+        ORDER BY site_id
+    """)
+    sites = [
+        {"site_id": row[0], "count": row[1], "last_timestamp": row[2], "last_received": row[3]}
+        for row in cursor.fetchall()
+    ]
+    conn.close()
+    return sites
+
+
+# === Agente de envio ===
+def _get_last_pushed(conn):
+    cursor = conn.execute("SELECT value FROM push_state WHERE key = 'last_pushed_id'")
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def _get_instance_id(conn):
+    """Id desta instância do banco, gerado uma única vez (texto UUID com hífens)."""
+    row = conn.execute("SELECT value FROM push_state WHERE key = 'instance_id'").fetchone()
+    if row:
+        return row[0]
+    instance_id = str(uuid.uuid4())
+    conn.execute("INSERT INTO push_state (key, value) VALUES ('instance_id', ?)", (instance_id,))
+    conn.commit()
+    return instance_id
+
+
+def _set_last_pushed(conn, last_id):
+    conn.execute(
+        "INSERT INTO push_state (key, value) VALUES ('last_pushed_id', ?) "
+        "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+        (last_id,)
+    )
+    conn.commit()
+
+
+def _read_pending(conn, last_id, batch_size):
+    cursor = conn.execute(
+        f"SELECT id, {', '.join(METRIC_FIELDS)} FROM metrics WHERE id > ? ORDER BY id ASC LIMIT ?",
+        (last_id, batch_size)
+    )
+    columns = ("id",) + METRIC_FIELDS
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def send_batch(url, site_id, instance_id, token, rows, timeout=30):
+    """Envia um lote ao endpoint /ingest do agregador."""
+    # Importado aqui: urllib.request (http.client, ssl) pesa na inicialização
+    import urllib.request
+
+    req = urllib.request.Request(
+        url,
+        data=encode_batch(rows),
+        method="POST",
+        headers={
+            "Content-Type": "application/x-ndjson",
+            "Content-Encoding": "gzip",
+            "Authorization": f"Bearer {token}",
+            "X-Site-Id": site_id,
+            "X-Instance-Id": instance_id,
+        },
+    )
+    with urllib.request.urlopen(req, timeout=timeout) as resp:
+        return json.loads(resp.read().decode("utf-8"))
+
+
+def push_loop(db_file, url, site_id, token, interval=60, batch_size=500,
+              max_backoff=900, stop_event=None):
+    """Envia periodicamente as linhas locais ainda não aceitas pelo agregador.
+
+    Em caso de falha, tenta novamente com backoff exponencial (com jitter)
+    até ``max_backoff`` segundos; o cursor só avança após confirmação.
+    """
+    print(f"[INFO] Agente de envio iniciado: site={site_id} → {url}", flush=True)
+    backoff = 0
+
+    def wait(seconds):
+        if stop_event is not None:
+            return stop_event.wait(timeout=seconds)
+        time.sleep(seconds)
+        return False
+
+    while True:
+        try:
+            conn = sqlite3.connect(db_file)
+            try:
+                instance_id = _get_instance_id(conn)
+                last_id = _get_last_pushed(conn)
+                rows = _read_pending(conn, last_id, batch_size)
+                if rows:
+                    result = send_batch(url, site_id, instance_id, token, rows)
+                    _set_last_pushed(conn, rows[-1]["id"])
+                    print(f"[OK] Lote enviado: {len(rows)} registros (novos no agregador: {result.get('inserted')})", flush=True)
+            finally:
+                conn.close()
+            backoff = 0
+            # Lote cheio: ainda há pendências, enviar o próximo sem esperar
+            if rows and len(rows) >= batch_size:
+                continue
+            if wait(interval):
+                return
+        except Exception as e:
+            # Qualquer erro (rede, HTTP malformado, banco) não pode matar o agente
+            backoff = min(max_backoff, max(5, backoff * 2))
+            delay = backoff * random.uniform(0.5, 1.0)
+            print(f"[WARN] Falha ao enviar lote: {e}. Nova tentativa em {delay:.0f}s", flush=True)
+            if wait(delay):
+                return
@@ -16,11 +16,16 @@ import RPi.GPIO as GPIO
 import json
 import os
 import socket
+import ringstore
 
 # Configurações do display
 DISPLAY_WIDTH = 128
 DISPLAY_HEIGHT = 64
 
+# Mesmas variáveis de ambiente do app.py (banco e config do monitor)
+DB_FILE = os.getenv('INTERNET_MONITOR_DB') or 'internet.db'
+CONFIG_FILE = os.getenv('INTERNET_MONITOR_CONFIG') or 'config.json'
+
 # Configurações dos botões GPIO
 BUTTON_PAUSE = 23   # GPIO23 - Botão PAUSE/RESUME
 
@@ -62,22 +67,42 @@ class OLEDMonitor:
         except:
             return "N/A"
     
+    def get_ring_pending(self, since):
+        """Medições recentes ainda no anel do app.py (storage_backend = "ring")."""
+        try:
+            with open(CONFIG_FILE, 'r') as f:
+                config = json.load(f)
+        except (OSError, ValueError):
+            return []
+        if config.get('storage_backend') != 'ring':
+            return []
+        path = config.get('ring_path') or ringstore.default_path(DB_FILE)
+        try:
+            ring = ringstore.RingStore(path, readonly=True)
+        except (OSError, ValueError):
+            return []
+        try:
+            return ring.pending(since=since)
+        finally:
+            ring.close()
+    
     def get_avg_stats_4h(self):
-        """Obtém médias das últimas 4 horas do banco de dados."""
+        """Obtém médias das últimas 4 horas do banco de dados (e do anel, se ativo)."""
         try:
-            conn = sqlite3.connect('internet.db')
+            conn = sqlite3.connect(DB_FILE)
             cursor = conn.cursor()
             
             # Timestamp de 4 horas atrás
-            four_hours_ago = (datetime.now() - timedelta(hours=4)).strftime('%Y-%m-%d %H:%M:%S')
+            since = datetime.now() - timedelta(hours=4)
+            four_hours_ago = since.strftime('%Y-%m-%d %H:%M:%S')
             
-            # Query para obter médias
+            # Somas e contagens, para combinar com as medições do anel
             cursor.execute("""
                 SELECT 
-                    AVG(ping_avg) as avg_ping,
-                    AVG(download_mbps) as avg_down,
-                    AVG(upload_mbps) as avg_up,
-                    AVG(jitter) as avg_jitter,
+                    SUM(ping_avg), COUNT(ping_avg),
+                    SUM(download_mbps), COUNT(download_mbps),
+                    SUM(upload_mbps), COUNT(upload_mbps),
+                    SUM(jitter), COUNT(jitter),
                     COUNT(*) as count
                 FROM metrics
                 WHERE timestamp >= ?
@@ -86,14 +111,26 @@ class OLEDMonitor:
             row = cursor.fetchone()
             conn.close()
             
-            if row and row[0] is not None and row[4] > 0:
-                return {
-                    'ping': row[0],
-                    'download': row[1],
-                    'upload': row[2],
-                    'jitter': row[3],
-                    'count': row[4]
-                }
+            sums = {
+                'ping': [row[0] or 0, row[1]],
+                'download': [row[2] or 0, row[3]],
+                'upload': [row[4] or 0, row[5]],
+                'jitter': [row[6] or 0, row[7]],
+            }
+            count = row[8]
+            
+            columns = {'ping': 'ping_avg', 'download': 'download_mbps', 'upload': 'upload_mbps', 'jitter': 'jitter'}
+            for record in self.get_ring_pending(since):
+                count += 1
+                for key, column in columns.items():
+                    if record[column] is not None:
+                        sums[key][0] += record[column]
+                        sums[key][1] += 1
+            
+            if count > 0 and sums['ping'][1] > 0:
+                stats = {key: (total / n if n else None) for key, (total, n) in sums.items()}
+                stats['count'] = count
+                return stats
             return None
         except Exception as e:
             print(f"[ERRO] Falha ao obter stats: {e}")
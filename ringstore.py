@@ -0,0 +1,287 @@
+"""
+Armazenamento em anel (ring buffer) para medições recentes
+Arquivo de tamanho fixo mapeado em memória (mmap) com registros binários
+de largura fixa; descarregado no SQLite em lote, reduzindo escritas no cartão SD.
+
+Layout do arquivo:
+    cabeçalho: magic, tamanho do registro, capacidade, write_seq, flushed_seq
+    registros: capacity × RECORD, posição = seq % capacity
+
+Registros com seq em [flushed_seq, write_seq) ainda não estão no SQLite.
+
+As tentativas de teste do mesmo período ficam em um arquivo ao lado do anel
+(EventLog, um JSON por linha) e são gravadas na mesma descarga.
+"""
+
+import hashlib
+import json
+import math
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import time
+
+MAGIC = b"IMRING01"
+HEADER = struct.Struct("<8sIIQQ")
+# timestamp (epoch local), ping, download, upload, jitter, perda, consumo, provedor
+PROVIDER_BYTES = 48
+RECORD = struct.Struct(f"<7d{PROVIDER_BYTES}s")
+TS_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Mesma ordem das colunas da tabela metrics
+FIELDS = (
+    "timestamp",
+    "ping_avg",
+    "download_mbps",
+    "upload_mbps",
+    "jitter",
+    "packet_loss",
+    "provider",
+    "data_consumed_mb",
+)
+
+
+def default_path(db_file):
+    """Usa tmpfs (/dev/shm) quando disponível; senão, ao lado do banco.
+
+    O nome inclui um hash do caminho absoluto do banco: dois monitores com
+    bancos homônimos em diretórios diferentes não compartilham o anel.
+    """
+    db_path = os.path.abspath(db_file)
+    digest = hashlib.sha1(db_path.encode("utf-8")).hexdigest()[:8]
+    name = f"{os.path.splitext(os.path.basename(db_path))[0]}-{digest}.ring"
+    if os.path.isdir("/dev/shm"):
+        return os.path.join("/dev/shm", name)
+    return os.path.join(os.path.dirname(os.path.abspath(db_file)), name)
+
+
+def fit_provider(name):
+    """Corta o nome do provedor para caber no registro, sem partir caracteres UTF-8.
+
+    Quem grava no anel deve usar este mesmo nome em providers/test_events,
+    para que o filtro por provedor continue casando após a descarga.
+    """
+    if not name:
+        return name
+    return name.encode("utf-8")[:PROVIDER_BYTES].decode("utf-8", errors="ignore")
+
+
+def _num(value):
+    return float("nan") if value is None else float(value)
+
+
+def _opt(value):
+    return None if math.isnan(value) else value
+
+
+def _pack(row):
+    epoch = time.mktime(time.strptime(row["timestamp"], TS_FORMAT))
+    provider = (fit_provider(row.get("provider")) or "").encode("utf-8")
+    return RECORD.pack(
+        epoch,
+        _num(row.get("ping_avg")),
+        _num(row.get("download_mbps")),
+        _num(row.get("upload_mbps")),
+        _num(row.get("jitter")),
+        _num(row.get("packet_loss")),
+        _num(row.get("data_consumed_mb")),
+        provider,
+    )
+
+
+def _unpack(values):
+    epoch, ping, down, up, jitter, loss, consumed, provider = values
+    provider = provider.rstrip(b"\x00").decode("utf-8") or None
+    return {
+        "timestamp": time.strftime(TS_FORMAT, time.localtime(epoch)),
+        "ping_avg": _opt(ping),
+        "download_mbps": _opt(down),
+        "upload_mbps": _opt(up),
+        "jitter": _opt(jitter),
+        "packet_loss": _opt(loss),
+        "provider": provider,
+        "data_consumed_mb": _opt(consumed),
+    }
+
+
+class RingStore:
+    def __init__(self, path, capacity=4096, readonly=False):
+        """Abre (ou cria) o anel. Um anel existente mantém sua capacidade."""
+        self.path = path
+        self.readonly = readonly
+        self._lock = threading.Lock()
+
+        if readonly:
+            self._file = open(path, "rb")
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            if not self._valid_file(path):
+                with open(path, "wb") as f:
+                    f.write(HEADER.pack(MAGIC, RECORD.size, capacity, 0, 0))
+                    f.truncate(HEADER.size + capacity * RECORD.size)
+            self._file = open(path, "r+b")
+            self._mm = mmap.mmap(self._file.fileno(), 0)
+
+        magic, record_size, self.capacity, _, _ = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or record_size != RECORD.size:
+            raise ValueError(f"Arquivo de anel inválido: {path}")
+
+    @staticmethod
+    def _valid_file(path):
+        try:
+            with open(path, "rb") as f:
+                header = f.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    return False
+                magic, record_size, capacity, _, _ = HEADER.unpack(header)
+                f.seek(0, os.SEEK_END)
+                return (magic == MAGIC and record_size == RECORD.size
+                        and f.tell() == HEADER.size + capacity * RECORD.size)
+        except OSError:
+            return False
+
+    def _seqs(self):
+        _, _, _, write_seq, flushed_seq = HEADER.unpack_from(self._mm, 0)
+        return write_seq, flushed_seq
+
+    def _set_seqs(self, write_seq, flushed_seq):
+        HEADER.pack_into(self._mm, 0, MAGIC, RECORD.size, self.capacity, write_seq, flushed_seq)
+
+    def _scan(self, first_seq, end_seq):
+        """Percorre os registros [first_seq, end_seq) direto do mmap, sem cópia."""
+        first_seq = max(first_seq, end_seq - self.capacity)
+        view = memoryview(self._mm)
+        try:
+            while first_seq < end_seq:
+                slot = first_seq % self.capacity
+                count = min(end_seq - first_seq, self.capacity - slot)
+                start = HEADER.size + slot * RECORD.size
+                yield from RECORD.iter_unpack(view[start:start + count * RECORD.size])
+                first_seq += count
+        finally:
+            view.release()
+
+    def pending_count(self):
+        write_seq, flushed_seq = self._seqs()
+        return write_seq - flushed_seq
+
+    def append(self, row, db_file=None):
+        """Grava uma medição. Se o anel estiver cheio de pendências, descarrega antes."""
+        record = _pack(row)
+        if db_file and self.pending_count() >= self.capacity:
+            self.flush_to_sqlite(db_file)
+        with self._lock:
+            write_seq, flushed_seq = self._seqs()
+            offset = HEADER.size + (write_seq % self.capacity) * RECORD.size
+            self._mm[offset:offset + RECORD.size] = record
+            # O registro é gravado antes de avançar o contador (leitores de outro processo)
+            self._set_seqs(write_seq + 1, max(flushed_seq, write_seq + 1 - self.capacity))
+
+    def pending(self, since=None, provider=None):
+        """Medições ainda não descarregadas no SQLite, como dicts no formato de metrics."""
+        since_epoch = time.mktime(since.timetuple()) if since is not None else None
+        with self._lock:
+            write_seq, flushed_seq = self._seqs()
+            rows = []
+            for values in self._scan(flushed_seq, write_seq):
+                if since_epoch is not None and values[0] < since_epoch:
+                    continue
+                row = _unpack(values)
+                if provider is not None and row["provider"] != provider:
+                    continue
+                rows.append(row)
+        return rows
+
+    def flush_to_sqlite(self, db_file, before_commit=None):
+        """Descarrega as pendências em uma única transação. Retorna a quantidade.
+
+        ``before_commit(conn)``, se informado, grava dados associados (eventos)
+        na mesma transação, mesmo sem medições pendentes.
+        """
+        if self.readonly:
+            return 0
+        with self._lock:
+            write_seq, flushed_seq = self._seqs()
+            rows = [_unpack(values) for values in self._scan(flushed_seq, write_seq)]
+            if not rows and before_commit is None:
+                return 0
+            conn = sqlite3.connect(db_file)
+            try:
+                # Idempotente: uma queda entre o commit e o cabeçalho não duplica linhas
+                conn.executemany(
+                    f"INSERT INTO metrics ({', '.join(FIELDS)}) "
+                    f"SELECT {', '.join('?' * len(FIELDS))} "
+                    "WHERE NOT EXISTS (SELECT 1 FROM metrics WHERE timestamp = ?)",
+                    [tuple(row[field] for field in FIELDS) + (row["timestamp"],) for row in rows]
+                )
+                if before_commit is not None:
+                    before_commit(conn)
+                conn.commit()
+            finally:
+                conn.close()
+            self._set_seqs(write_seq, write_seq)
+        return len(rows)
+
+    def close(self):
+        self._mm.close()
+        self._file.close()
+
+
+class EventLog:
+    """Tentativas de teste pendentes do modo anel, um JSON por linha.
+
+    Só cresce entre descargas (uma linha por teste); ``drop`` remove as
+    primeiras linhas depois que foram gravadas no SQLite.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def append(self, event):
+        line = json.dumps(event, separators=(",", ":"))
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+    def _read(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return []
+        result = []
+        for line in lines:
+            try:
+                result.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue  # Linha incompleta (queda durante a escrita)
+        return result
+
+    def pending(self):
+        with self._lock:
+            return self._read()
+
+    def drop(self, count):
+        """Remove as ``count`` primeiras tentativas (já gravadas no SQLite)."""
+        if count <= 0:
+            return
+        with self._lock:
+            remaining = self._read()[count:]
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.writelines(json.dumps(event, separators=(",", ":")) + "\n" for event in remaining)
+            os.replace(tmp_path, self.path)
+
+
+def flush_loop(flush, interval, stop_event):
+    """Chama ``flush`` (descarga do anel no SQLite) a cada ``interval`` segundos."""
+    while not stop_event.wait(timeout=interval):
+        try:
+            count = flush()
+            if count:
+                print(f"[INFO] Anel descarregado no SQLite: {count} registros", flush=True)
+        except Exception as e:
+            print(f"[ERRO] Falha ao descarregar anel: {e}", flush=True)